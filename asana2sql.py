@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 
 import argparse
+import logging
+import os
 import pyodbc
 import requests
+import threading
 
 from asana2sql.fields import default_fields
-from asana2sql.Project import Project
+from asana2sql.Project import Project, SUBTASK_FETCH_WORKERS
 from asana2sql.workspace import Workspace
 from asana2sql.db_wrapper import DatabaseWrapper
 from asana import Client, session
 
+logger = logging.getLogger(__name__)
+
 def arg_parser():
     parser = argparse.ArgumentParser()
 
@@ -31,6 +36,23 @@ def arg_parser():
             default=False,
             help="Print performance information on completion.")
 
+    parser.add_argument(
+            '--verbose',
+            action="store_true",
+            default=False,
+            help="Log progress and debugging information to STDERR.")
+
+    parser.add_argument(
+            '--metadata_cache',
+            default=os.path.join(os.path.expanduser("~"), ".asana2sql_cache"),
+            help="File used to cache project metadata between runs.")
+
+    parser.add_argument(
+            '--no_cache',
+            action="store_true",
+            default=False,
+            help="Refresh cached project metadata from Asana.")
+
     parser.add_argument("--projects_table_name")
     parser.add_argument("--project_memberships_table_name")
     parser.add_argument("--users_table_name")
@@ -84,6 +106,13 @@ def arg_parser():
             default=False,
             help="Dry run.  Do not actually run any writes to the database.")
 
+    db_args.add_argument(
+            "--no_staging_table",
+            action="store_true",
+            default=False,
+            help=("Synchronize by upserting rows directly instead of through "
+                  "a temporary staging table."))
+
     # Commands
     subparsers = parser.add_subparsers(
             title="Commands",
@@ -105,9 +134,15 @@ def arg_parser():
     return parser
 
 def build_asana_client(args):
-    options = {
-        'session': session.AsanaOAuth2Session(
-            token={'access_token': args.access_token})}
+    asana_session = session.AsanaOAuth2Session(
+            token={'access_token': args.access_token})
+    # Keep a pooled connection per concurrent subtask request, plus one for
+    # the main thread, which pages through the project's tasks meanwhile.
+    asana_session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=SUBTASK_FETCH_WORKERS + 1))
+
+    options = {'session': asana_session}
 
     if args.base_url:
         options['base_url'] = args.base_url
@@ -123,6 +158,8 @@ class RequestCountingClient(Client):
     def __init__(self, dump_api=False, session=None, auth=None, **options):
         Client.__init__(self, session=session, auth=auth, **options)
         self._dump_api = dump_api
+        # Requests are issued from several threads, so guard the counter.
+        self._num_requests_lock = threading.Lock()
         self._num_requests = 0
 
     @property
@@ -132,45 +169,60 @@ class RequestCountingClient(Client):
     def request(self, method, path, **options):
         if self._dump_api:
             print("{}: {}".format(method, path))
-        self._num_requests += 1
+        with self._num_requests_lock:
+            self._num_requests += 1
         return Client.request(self, method, path, **options)
 
 def main():
     args = arg_parser().parse_args()
-    
+
+    # Only raise this project's loggers; third-party DEBUG logs (e.g.
+    # requests_oauthlib) include the access token.
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        logging.getLogger("asana2sql").setLevel(logging.DEBUG)
+        logger.setLevel(logging.DEBUG)
+        for driver in pyodbc.drivers():
+            logger.debug("ODBC driver: %s", driver)
+
     client = build_asana_client(args)
 
     db_client = None
     if args.odbc_string:
-        print("Connecting to database.")
-        db_client = pyodbc.connect(args.odbc_string)
+        logger.debug("Connecting to database.")
+        # Run the whole command in one transaction rather than committing
+        # every statement.
+        db_client = pyodbc.connect(args.odbc_string, autocommit=False)
 
     db_wrapper = DatabaseWrapper(db_client, dump_sql=args.dump_sql, dry=args.dry)
-    print("workspace...")
+    logger.debug("Loading workspace.")
     workspace = Workspace(client, db_wrapper, args)
-    print("project...")
+    logger.debug("Loading project.")
     project = Project(
             client, db_wrapper, workspace, args, default_fields(workspace))
 
-    if args.command == 'create':
-        print("create...")
-        project.create_table()
-        workspace.create_tables()
-    elif args.command == 'export':
-        project.export()
-    elif args.command == 'synchronize':
-        project.synchronize()
-
-    if not args.dry:
+    try:
+        if args.command == 'create':
+            logger.debug("Creating tables.")
+            project.create_table()
+            workspace.create_tables()
+        elif args.command == 'export':
+            project.export()
+        elif args.command == 'synchronize':
+            project.synchronize()
+    except:
+        if db_client:
+            db_client.rollback()
+        raise
+
+    if db_client and not args.dry:
         db_client.commit()
 
     if args.dump_perf:
         print("API Requests: {}".format(client.num_requests))
         print("DB Commands: reads = {}, writes = {}, executed = {}".format(
-            db_wrapper.num_reads, db_wrapper.num_writes, db_wrapper.num_commands_executed))
+            db_wrapper.num_reads, db_wrapper.num_writes, db_wrapper.num_executed))
 
 if __name__ == '__main__':
-    for driver in pyodbc.drivers():
-        print(driver)
     main()
 
@@ -1,22 +1,66 @@
 from asana2sql import util
+from asana2sql.cache import DiskCache
+import asana
 import asana.error
+import collections
+from concurrent import futures
 import itertools
+import logging
 
 from asana2sql import fields
 from asana2sql import workspace
 
+logger = logging.getLogger(__name__)
+
 CREATE_TABLE_TEMPLATE = (
         """CREATE TABLE IF NOT EXISTS "{table_name}" ({columns});""")
 
-#INSERT_OR_REPLACE_TEMPLATE = ("""INSERT OR REPLACE INTO "{table_name}" ({columns}) VALUES ({values});""")
+SET_EXCLUDED_TEMPLATE = """{name}=excluded.{name}"""
+
 INSERT_OR_REPLACE_TEMPLATE = ("""INSERT INTO "{table_name}" ({columns}) VALUES ({values}) ON CONFLICT (gid) DO UPDATE SET {set_command};""")
 
+CREATE_STAGING_TABLE_TEMPLATE = (
+        """CREATE TEMPORARY TABLE "{staging_table_name}" AS """
+        """SELECT {columns} FROM "{table_name}" WHERE 1 = 0;""")
+INSERT_STAGING_TEMPLATE = (
+        """INSERT INTO "{staging_table_name}" ({columns}) VALUES ({values});""")
+# The WHERE clause is needed by SQLite to parse ON CONFLICT after a SELECT.
+MERGE_STAGING_TEMPLATE = (
+        """INSERT INTO "{table_name}" ({columns}) """
+        """SELECT {columns} FROM "{staging_table_name}" WHERE 1 = 1 """
+        """ON CONFLICT (gid) DO UPDATE SET {set_command};""")
+# NOT EXISTS plans as an anti-join, unlike NOT IN, and isn't defeated by NULLs.
+DELETE_MISSING_FROM_STAGING_TEMPLATE = (
+        """DELETE FROM "{table_name}" WHERE NOT EXISTS """
+        """(SELECT 1 FROM "{staging_table_name}" s """
+        """WHERE s.{id_column} = "{table_name}".{id_column});""")
+DROP_STAGING_TABLE_TEMPLATE = (
+        """DROP TABLE "{staging_table_name}";""")
 
 SELECT_TEMPLATE = (
         """SELECT {columns} FROM "{table_name}";""")
 
+# How long fetched project metadata stays valid in the on-disk cache.
+PROJECT_DATA_CACHE_TTL_SECONDS = 60 * 60
+
+# Number of concurrent requests used to fetch subtasks from Asana.
+SUBTASK_FETCH_WORKERS = 16
+
+# Number of subtask fetches that may be queued or holding unconsumed results,
+# which bounds the subtasks held in memory while tasks are streamed.
+MAX_PENDING_SUBTASK_FETCHES = 2 * SUBTASK_FETCH_WORKERS
+
+# Number of task rows sent to the database in a single batch.
+INSERT_BATCH_SIZE = 5000
+
+# Number of task ids deleted by a single statement, kept under SQLite's limit
+# of 999 bound parameters.
+DELETE_BATCH_SIZE = 900
+
 DELETE_TEMPLATE = (
         """DELETE FROM "{table_name}" WHERE {id_column} = ?;""")
+DELETE_MANY_TEMPLATE = (
+        """DELETE FROM "{table_name}" WHERE {id_column} IN ({values});""")
 
 class NoSuchProjectException(Exception):
     def __init__(self, project_id):
@@ -40,40 +84,112 @@ class Project(object):
         self._table_name = self._config.table_name
 
         self._project_data_cache = None
+        self._project_data_disk_cache = None
+        self._refresh_project_data = config.no_cache
+        if config.metadata_cache:
+            self._project_data_disk_cache = DiskCache(
+                    config.metadata_cache,
+                    PROJECT_DATA_CACHE_TTL_SECONDS,
+                    version=asana.__version__)
         self._task_cache = None
+        self._insert_sql = None
+        self._cached_table_name = None
 
         for field in fields:
             self._add_field(field)
 
+        # The fields are fixed from here on, so the Asana fields parameter is too.
+        self._all_fields = self._direct_fields + self._indirect_fields
+        self._required_fields_str = ",".join(sorted(self._required_fields()))
+
+        # Values are bound as parameters, so these SQL fragments are the same
+        # for every task.
+        self._columns_sql = ",".join(
+                [field.sql_name for field in self._direct_fields])
+        self._values_sql = ",".join(["?"] * len(self._direct_fields))
+        self._set_command_sql = ",".join(
+                [SET_EXCLUDED_TEMPLATE.format(name=field.sql_name)
+                 for field in self._direct_fields])
+
     def _project_data(self):
-        """Fetch the project data from Asana and cache it."""
+        """Fetch the project data from Asana and cache it.
+
+        If configured, the data is also cached on disk across runs.
+        """
         if self._project_data_cache is None:
-            try:
+            disk_cache_key = "project:{}".format(self._project_id)
+            if self._project_data_disk_cache and not self._refresh_project_data:
                 self._project_data_cache = (
-                    self._asana_client.projects.find_by_id(self._project_id))
-            except asana.error.NotFoundError:
-                raise NoSuchProjectException(self._project_id)
+                    self._project_data_disk_cache.get(disk_cache_key))
+
+            if self._project_data_cache is None:
+                try:
+                    self._project_data_cache = (
+                        self._asana_client.projects.find_by_id(self._project_id))
+                except asana.error.NotFoundError:
+                    raise NoSuchProjectException(self._project_id)
+
+                if self._project_data_disk_cache:
+                    self._project_data_disk_cache.put(
+                            disk_cache_key, self._project_data_cache)
         return self._project_data_cache
 
     def _required_fields(self):
-        return set(field_names for field in self._direct_fields + self._indirect_fields
-                               for field_names in field.required_fields())
+        return {field_name for field in self._all_fields
+                           for field_name in field.required_fields()}
 
     def _tasks(self):
         if self._task_cache is None:
-            self._task_cache = list(self._asana_client.tasks.find_by_project(self._project_id, fields=",".join(self._required_fields())))
-            project_tasks = self._asana_client.tasks.find_by_project(self._project_id, fields=",".join(self._required_fields()))
-            for task in project_tasks:
-                task_id = task['gid']
-                sub_tasks = self._asana_client.tasks.subtasks(task_id, fields=",".join(self._required_fields()))
-                for sub_task in sub_tasks:
-                    print(sub_task['name'])
-                    self._task_cache.append(sub_task)
-        return self._task_cache
-
+            self._task_cache = {
+                    task['gid']: task for task in self._iter_tasks()}
+        return self._task_cache.values()
+
+    def _iter_tasks(self):
+        """Yield the project's tasks and their subtasks as they arrive.
+
+        Top-level tasks are yielded page by page while the subtasks of tasks
+        that have any are fetched in the background.  At most
+        MAX_PENDING_SUBTASK_FETCHES fetches are outstanding; once that many
+        are queued the oldest one's subtasks are yielded before more are
+        requested.  A task is only yielded once, even if it is returned more
+        than once by Asana.
+        """
+        fields = self._required_fields_str
+        seen_task_ids = set()
+
+        def fetch_subtasks(task_id):
+            return list(self._asana_client.tasks.subtasks(task_id, fields=fields))
+
+        def unseen(tasks):
+            for task in tasks:
+                if task['gid'] not in seen_task_ids:
+                    seen_task_ids.add(task['gid'])
+                    yield task
+
+        with futures.ThreadPoolExecutor(
+                max_workers=SUBTASK_FETCH_WORKERS) as executor:
+            subtask_futures = collections.deque()
+            for task in unseen(self._asana_client.tasks.find_by_project(
+                    self._project_id, fields=fields + ",num_subtasks")):
+                yield task
+
+                # Only tasks known to have subtasks need another request.
+                if task.get('num_subtasks') != 0:
+                    while len(subtask_futures) >= MAX_PENDING_SUBTASK_FETCHES:
+                        for sub_task in unseen(subtask_futures.popleft().result()):
+                            yield sub_task
+                    subtask_futures.append(
+                            executor.submit(fetch_subtasks, task['gid']))
+
+            while subtask_futures:
+                for sub_task in unseen(subtask_futures.popleft().result()):
+                    yield sub_task
 
     def table_name(self):
-        return util.sql_safe_name(self._table_name if self._table_name else self.project_name())
+        if self._cached_table_name is None:
+            self._cached_table_name = util.sql_safe_name(
+                    self._table_name if self._table_name else self.project_name())
+        return self._cached_table_name
 
     def project_name(self):
         return self._project_data()["name"]
@@ -85,43 +201,84 @@ class Project(object):
             self._indirect_fields.append(field)
 
     def create_table(self):
-        print("create_table...")
-        print(self.table_name())
+        logger.debug("Creating table %s.", self.table_name())
         sql = CREATE_TABLE_TEMPLATE.format(
                 table_name=self.table_name(),
                 columns=",".join([
                         field.field_definition_sql() for field in self._direct_fields]))
-        print("db write sql:")
-        print(sql)
         self._db_client.write(sql)
 
     def export(self):
-        for task in self._tasks():
-            self.insert_or_replace(task)
+        self._write_tasks(self._iter_tasks())
+
+    def _write_tasks(self, tasks, sql=None):
+        """Upsert the tasks, sending the rows to the database in batches.
+
+        If sql is given the rows are written with it instead of the upsert.
+        """
+        sql = sql or self._insert_or_replace_sql()
+        batch = []
+        for task in tasks:
+            batch.append(self._task_row(task))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                self._db_client.write_many(sql, batch)
+                batch = []
+        if batch:
+            self._db_client.write_many(sql, batch)
+
+    def _synchronize_through_staging_table(self, tasks):
+        """Bulk load the tasks into a temporary table, then upsert them all and
+        delete the rows of missing tasks with one statement each.
+        """
+        staging_table_name = self.table_name() + "_staging"
 
-    def insert_or_replace(self, task):
-        columns = ",".join(field.sql_name for field in self._direct_fields)
-        values = ",".join("?" for field in self._direct_fields)
-        #set_command = ",".join(field.sql_name + "=" + ("'" + field.get_data_from_task(task)+ "'") if field.get_data_from_task(task) else next for field in self._direct_fields)
-        #set_command = ",".join(field.sql_name + "=" + ("'" + field.get_data_from_task(task)+ "'") if field.get_data_from_task(task) else '' for field in self._direct_fields)
-        set_command = ''
-        for field in self._direct_fields:
-            if set_command != '' and field.get_data_from_task(task):
-                set_command = set_command + ', '
-            if field.get_data_from_task(task):
-                set_command = set_command + " " + field.sql_name + " = " + "'" + field.get_data_from_task(task) + "'" 
-        params = [field.get_data_from_task(task) for field in self._direct_fields]
         self._db_client.write(
-                INSERT_OR_REPLACE_TEMPLATE.format(
+                CREATE_STAGING_TABLE_TEMPLATE.format(
+                    staging_table_name=staging_table_name,
+                    table_name=self.table_name(),
+                    columns=self._columns_sql))
+        self._write_tasks(
+                tasks,
+                INSERT_STAGING_TEMPLATE.format(
+                    staging_table_name=staging_table_name,
+                    columns=self._columns_sql,
+                    values=self._values_sql))
+        self._db_client.write(
+                MERGE_STAGING_TEMPLATE.format(
+                    table_name=self.table_name(),
+                    staging_table_name=staging_table_name,
+                    columns=self._columns_sql,
+                    set_command=self._set_command_sql))
+        self._db_client.write(
+                DELETE_MISSING_FROM_STAGING_TEMPLATE.format(
                     table_name=self.table_name(),
-                    columns=columns,
-                    values=values,
-                    set_command=set_command),
-                *params)
+                    staging_table_name=staging_table_name,
+                    id_column=self._id_field().sql_name))
+        self._db_client.write(
+                DROP_STAGING_TABLE_TEMPLATE.format(
+                    staging_table_name=staging_table_name))
+
+    def _insert_or_replace_sql(self):
+        """Build the upsert statement once; it doesn't depend on the task."""
+        if self._insert_sql is None:
+            self._insert_sql = INSERT_OR_REPLACE_TEMPLATE.format(
+                    table_name=self.table_name(),
+                    columns=self._columns_sql,
+                    values=self._values_sql,
+                    set_command=self._set_command_sql)
+        return self._insert_sql
+
+    def _task_row(self, task):
+        params = tuple(field.get_data_from_task(task) for field in self._direct_fields)
 
         for field in self._indirect_fields:
             field.get_data_from_task(task)
 
+        return params
+
+    def insert_or_replace(self, task):
+        self._db_client.write(self._insert_or_replace_sql(), *self._task_row(task))
+
     def delete(self, task_id):
         id_field = self._id_field()
         self._db_client.write(
@@ -130,20 +287,34 @@ class Project(object):
                     id_column=id_field.sql_name),
                 task_id)
 
+    def delete_many(self, task_ids):
+        id_field = self._id_field()
+        for chunk in util.chunked(task_ids, DELETE_BATCH_SIZE):
+            self._db_client.write(
+                    DELETE_MANY_TEMPLATE.format(
+                        table_name=self.table_name(),
+                        id_column=id_field.sql_name,
+                        values=",".join("?" for task_id in chunk)),
+                    *chunk)
+
     def synchronize(self):
+        if not self._config.no_staging_table:
+            self._synchronize_through_staging_table(self._iter_tasks())
+            return
+
         db_task_ids = self.db_task_ids()
         asana_task_ids = self.asana_task_ids()
 
-        ids_to_remove = db_task_ids.difference(asana_task_ids)
+        ids_to_remove = db_task_ids - asana_task_ids
 
-        for task in self._tasks():
-            self.insert_or_replace(task)
+        self._write_tasks(self._tasks())
 
-        for id_to_remove in ids_to_remove:
-            self.delete(id_to_remove)
+        self.delete_many(ids_to_remove)
 
     def asana_task_ids(self):
-        return set(task.get("gid") for task in self._tasks())
+        """Return a view of the ids of the project's tasks in Asana."""
+        self._tasks()
+        return self._task_cache.keys()
 
     def _id_field(self):
         return self._direct_fields[0]  # TODO: make the id field special.
@@ -1,3 +1,16 @@
+import dbm
+import logging
+import pickle
+import shelve
+import time
+
+logger = logging.getLogger(__name__)
+
+# Errors from opening or reading a locked, corrupt or unwritable cache file.
+DISK_CACHE_ERRORS = dbm.error + (
+        OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError)
+
+
 class Cache(object):
     """A cache with a backing store.
 
@@ -52,3 +65,41 @@ class Cache(object):
         if old_value != new_value:
             self._insert_and_cache(key, new_value)
 
+
+class DiskCache(object):
+    """A persistent key-value cache whose entries expire after a TTL.
+
+    Entries written under a different version are treated as missing, so the
+    cache is invalidated whenever the version changes.  The cache is only an
+    optimization: if the file can't be used, reads miss and writes are
+    skipped.
+    """
+
+    def __init__(self, path, ttl, version=""):
+        self._path = path
+        self._ttl = ttl
+        self._version = version
+
+    def get(self, key):
+        try:
+            with shelve.open(self._path) as store:
+                entry = store.get(key)
+
+            if entry is None:
+                return None
+
+            (written_at, version, value) = entry
+        except DISK_CACHE_ERRORS as e:
+            logger.debug("Ignoring unreadable cache %s: %s", self._path, e)
+            return None
+
+        if version != self._version or time.time() - written_at > self._ttl:
+            return None
+        return value
+
+    def put(self, key, value):
+        try:
+            with shelve.open(self._path) as store:
+                store[key] = (time.time(), self._version, value)
+        except DISK_CACHE_ERRORS as e:
+            logger.debug("Not writing to cache %s: %s", self._path, e)
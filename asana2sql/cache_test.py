@@ -1,7 +1,11 @@
+import dbm
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 
-from asana2sql.cache import Cache
+from asana2sql.cache import Cache, DiskCache
 from asana2sql.test_fixtures import row
 
 class CacheTestCase(unittest.TestCase):
@@ -50,5 +54,64 @@ class CacheTestCase(unittest.TestCase):
         self.seed_fn.assert_called_once()
         self.insert_fn.assert_called_once_with({"foo": 3})
 
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_and_get(self):
+        cache = DiskCache(self.path, ttl=60)
+
+        self.assertIsNone(cache.get("key"))
+
+        cache.put("key", {"gid": 1})
+
+        self.assertEqual(cache.get("key"), {"gid": 1})
+        self.assertEqual(DiskCache(self.path, ttl=60).get("key"), {"gid": 1})
+
+    @mock.patch("asana2sql.cache.time.time")
+    def test_expired(self, time_fn):
+        cache = DiskCache(self.path, ttl=60)
+
+        time_fn.return_value = 1000
+        cache.put("key", {"gid": 1})
+
+        time_fn.return_value = 1060
+        self.assertEqual(cache.get("key"), {"gid": 1})
+
+        time_fn.return_value = 1061
+        self.assertIsNone(cache.get("key"))
+
+    def test_version_mismatch(self):
+        DiskCache(self.path, ttl=60, version="1").put("key", {"gid": 1})
+
+        self.assertIsNone(DiskCache(self.path, ttl=60, version="2").get("key"))
+
+    def test_corrupt_file(self):
+        with open(self.path, "w") as f:
+            f.write("not a database")
+        cache = DiskCache(self.path, ttl=60)
+
+        cache.put("key", {"gid": 1})
+        self.assertIsNone(cache.get("key"))
+
+    def test_unwritable_path(self):
+        cache = DiskCache(os.path.join(self.dir, "missing", "cache"), ttl=60)
+
+        cache.put("key", {"gid": 1})
+        self.assertIsNone(cache.get("key"))
+
+    @mock.patch("asana2sql.cache.shelve.open")
+    def test_locked_file(self, shelve_open):
+        shelve_open.side_effect = dbm.error[0]("Resource temporarily unavailable")
+        cache = DiskCache(self.path, ttl=60)
+
+        cache.put("key", {"gid": 1})
+        self.assertIsNone(cache.get("key"))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,3 +1,6 @@
+import logging
+
+logger = logging.getLogger(__name__)
 
 class DatabaseWrapper(object):
     """A simple wrapper for a DB API 2.0 connection.
@@ -12,6 +15,7 @@ class DatabaseWrapper(object):
         self._dump_sql = dump_sql
         self._dry = dry
         self._cursor = None
+        self._batch_cursor = None
 
         self._num_reads = 0
         self._num_writes = 0
@@ -56,10 +60,39 @@ class DatabaseWrapper(object):
         if not self._dry:
             self._execute_sql(sql, *params)
 
+    def write_many(self, sql, rows):
+        """Execute a write SQL statement once for each row of parameters.
+
+        The rows are sent to the database in a single batch.  Batches use their
+        own cursor, which single statements never touch, so the driver keeps
+        the batched statement prepared between batches.
+        """
+        self._num_writes += 1
+
+        if self._dump_sql:
+            if self._dry:
+                print("# " + sql + " " + repr(rows))
+            else:
+                print(sql + " " + repr(rows))
+
+        if not self._dry:
+            self._execute_many_sql(sql, rows)
+
+    def _execute_many_sql(self, sql, rows):
+        if not self._batch_cursor:
+            self._batch_cursor = self._db_conn.cursor()
+            try:
+                # Only PyODBC supports binding the rows as parameter arrays.
+                self._batch_cursor.fast_executemany = True
+            except AttributeError:
+                pass
+        self._num_executed += 1
+        logger.debug("%s (%d rows)", sql, len(rows))
+        self._batch_cursor.executemany(sql, rows)
+
     def _execute_sql(self, sql, *params):
         if not self._cursor:
             self._cursor = self._db_conn.cursor()
         self._num_executed += 1
-        print(sql)
-        print(*params)
+        logger.debug("%s %r", sql, params)
         self._cursor.execute(sql, *params)
@@ -80,6 +80,53 @@ class DatabaseWrapperTestCase(unittest.TestCase):
 
         self.assertEqual(self.conn.mock_calls, [])
 
+    def test_write_many(self):
+        db_wrapper = DatabaseWrapper(self.conn)
+
+        db_wrapper.write_many(TEST_SQL, [(PARAM1,), (PARAM2,)])
+
+        self.assertEqual(db_wrapper.num_writes, 1)
+        self.assertEqual(db_wrapper.num_executed, 1)
+
+        self.assertEqual(self.conn.mock_calls, [
+            mock.call.cursor(),
+            mock.call.cursor().executemany(TEST_SQL, [(PARAM1,), (PARAM2,)]),
+            ])
+        self.assertTrue(self.conn.cursor().fast_executemany)
+
+    def test_write_many_uses_own_cursor(self):
+        cursor = mock.Mock()
+        batch_cursor = mock.Mock()
+        self.conn.cursor.side_effect = [batch_cursor, cursor]
+        db_wrapper = DatabaseWrapper(self.conn)
+
+        db_wrapper.write_many(TEST_SQL, [(PARAM1,)])
+        db_wrapper.write(TEST_SQL, PARAM1)
+        db_wrapper.read(TEST_SQL, PARAM2)
+        db_wrapper.write_many(TEST_SQL, [(PARAM2,)])
+
+        self.assertEqual(self.conn.cursor.call_count, 2)
+        self.assertTrue(batch_cursor.fast_executemany)
+        self.assertEqual(batch_cursor.mock_calls, [
+            mock.call.executemany(TEST_SQL, [(PARAM1,)]),
+            mock.call.executemany(TEST_SQL, [(PARAM2,)]),
+            ])
+        self.assertEqual(cursor.mock_calls, [
+            mock.call.execute(TEST_SQL, PARAM1),
+            mock.call.execute(TEST_SQL, PARAM2),
+            mock.call.fetchall(),
+            ])
+
+    def test_dry_write_many(self):
+        db_wrapper = DatabaseWrapper(self.conn, dry=True)
+
+        db_wrapper.write_many(TEST_SQL, [(PARAM1,), (PARAM2,)])
+
+        self.assertEqual(db_wrapper.num_writes, 1)
+        self.assertEqual(db_wrapper.num_executed, 0)
+
+        self.assertEqual(self.conn.mock_calls, [])
+
 
 if __name__ == '__main__':
     unittest.main()
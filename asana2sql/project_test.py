@@ -1,8 +1,11 @@
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 
-from asana2sql.project import Project
-from asana2sql.field import Field, SimpleField, SqlType
+from asana2sql.Project import Project
+from asana2sql.Field import Field, SimpleField, SqlType
 from asana2sql import test_fixtures as fixtures
 from asana2sql import db_wrapper
 from asana2sql import workspace
@@ -15,7 +18,11 @@ class ProjectTestCase(unittest.TestCase):
         self.config = mock.Mock()
         self.config.project_id = 1234
         self.config.table_name = "test_table"
+        self.config.metadata_cache = None
+        self.config.no_cache = False
+        self.config.no_staging_table = False
         self.workspace = mock.Mock(workspace.Workspace)
+        self.asana_client.tasks.subtasks.return_value = []
 
     def test_derived_table_name(self):
         proj = fixtures.project(id=1234, name="Test Table")
@@ -26,6 +33,16 @@ class ProjectTestCase(unittest.TestCase):
 
         self.assertEquals(project.table_name(), "Test_Table")
 
+    @mock.patch("asana2sql.util.sql_safe_name")
+    def test_table_name_cached(self, sql_safe_name):
+        sql_safe_name.return_value = "test_table"
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config, [])
+
+        self.assertEqual(project.table_name(), "test_table")
+        self.assertEqual(project.table_name(), "test_table")
+
+        sql_safe_name.assert_called_once_with("test_table")
+
     def test_create_empty_table(self):
         project = Project(self.asana_client, self.db_client, self.workspace, self.config, [])
 
@@ -59,16 +76,55 @@ class ProjectTestCase(unittest.TestCase):
         project.export()
 
         self.asana_client.tasks.find_by_project.assert_called_with(
-                1234, fields="gid")
+                1234, fields="gid,num_subtasks")
         self.db_client.read.assert_not_called()
-        self.db_client.write.assert_has_calls([
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 1),
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 2),
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 3)])
+        self.db_client.write_many.assert_called_once_with(
+                'INSERT INTO "test_table" (gid) VALUES (?) '
+                'ON CONFLICT (gid) DO UPDATE SET gid=excluded.gid;',
+                [(1,), (2,), (3,)])
+
+    def test_export_batches(self):
+        self.asana_client.tasks.find_by_project.return_value = [
+                fixtures.task(id=1), fixtures.task(id=2), fixtures.task(id=3)]
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        with mock.patch("asana2sql.Project.INSERT_BATCH_SIZE", 2):
+            project.export()
+
+        self.assertEqual(
+                [call[0][1] for call in self.db_client.write_many.call_args_list],
+                [[(1,), (2,)], [(3,)]])
 
     def test_synchronize(self):
+        self.asana_client.tasks.find_by_project.return_value = [
+                fixtures.task(id=2), fixtures.task(id=3), fixtures.task(id=4)]
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        project.synchronize()
+
+        self.asana_client.tasks.find_by_project.assert_called_with(
+                1234, fields="gid,num_subtasks")
+        self.db_client.read.assert_not_called()
+        self.db_client.write.assert_has_calls([
+                mock.call('CREATE TEMPORARY TABLE "test_table_staging" AS '
+                          'SELECT gid FROM "test_table" WHERE 1 = 0;'),
+                mock.call('INSERT INTO "test_table" (gid) '
+                          'SELECT gid FROM "test_table_staging" WHERE 1 = 1 '
+                          'ON CONFLICT (gid) DO UPDATE SET gid=excluded.gid;'),
+                mock.call('DELETE FROM "test_table" WHERE NOT EXISTS '
+                          '(SELECT 1 FROM "test_table_staging" s '
+                          'WHERE s.gid = "test_table".gid);'),
+                mock.call('DROP TABLE "test_table_staging";')])
+        self.db_client.write_many.assert_called_once_with(
+                'INSERT INTO "test_table_staging" (gid) VALUES (?);',
+                [(2,), (3,), (4,)])
+
+    def test_synchronize_without_staging_table(self):
         existing_rows = [fixtures.row(id=1), fixtures.row(id=2), fixtures.row(id=3)]
         self.db_client.read.return_value = existing_rows
+        self.config.no_staging_table = True
 
         self.asana_client.tasks.find_by_project.return_value = [
                 fixtures.task(id=2), fixtures.task(id=3), fixtures.task(id=4)]
@@ -77,15 +133,140 @@ class ProjectTestCase(unittest.TestCase):
                           [SimpleField("gid", SqlType.INTEGER)])
         project.synchronize()
 
-        self.asana_client.tasks.find_by_project.assert_called_with(
-                1234, fields="gid")
-        self.db_client.read.assert_called_with('SELECT id FROM "test_table";')
-        self.db_client.write.assert_called_with(
-                'DELETE FROM "test_table" WHERE id = ?;', 1)
+        self.db_client.read.assert_called_with('SELECT gid FROM "test_table";')
+        self.db_client.write.assert_called_once_with(
+                'DELETE FROM "test_table" WHERE gid IN (?);', 1)
+        self.db_client.write_many.assert_called_once_with(
+                'INSERT INTO "test_table" (gid) VALUES (?) '
+                'ON CONFLICT (gid) DO UPDATE SET gid=excluded.gid;',
+                [(2,), (3,), (4,)])
+
+    def test_delete_many(self):
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        with mock.patch("asana2sql.Project.DELETE_BATCH_SIZE", 2):
+            project.delete_many([1, 2, 3])
+
         self.db_client.write.assert_has_calls([
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 2),
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 3),
-                mock.call('INSERT OR REPLACE INTO "test_table" (id) VALUES (?);', 4)])
+                mock.call('DELETE FROM "test_table" WHERE gid IN (?,?);', 1, 2),
+                mock.call('DELETE FROM "test_table" WHERE gid IN (?);', 3)])
+        self.assertEqual(self.db_client.write.call_count, 2)
+
+    def test_insert_or_replace_reads_each_field_once(self):
+        field = mock.Mock(SimpleField("gid", SqlType.INTEGER))
+        field.sql_name = "gid"
+        field.required_fields.return_value = {"gid"}
+        field.get_data_from_task.return_value = 1
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [field])
+        project.insert_or_replace(fixtures.task(id=1))
+        project.insert_or_replace(fixtures.task(id=1))
+
+        self.assertEqual(field.get_data_from_task.call_count, 2)
+        self.db_client.write.assert_called_with(
+                'INSERT INTO "test_table" (gid) VALUES (?) '
+                'ON CONFLICT (gid) DO UPDATE SET gid=excluded.gid;', 1)
+
+    def test_export_writes_before_fetch_finishes(self):
+        written_before_last_task = []
+
+        def find_by_project(project_id, fields):
+            yield fixtures.task(id=1)
+            yield fixtures.task(id=2)
+            written_before_last_task.append(self.db_client.write_many.call_count)
+            yield fixtures.task(id=3)
+        self.asana_client.tasks.find_by_project.side_effect = find_by_project
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        with mock.patch("asana2sql.Project.INSERT_BATCH_SIZE", 2):
+            project.export()
+
+        self.assertEqual(written_before_last_task, [1])
+        self.assertEqual(self.db_client.write_many.call_count, 2)
+
+    def test_export_bounds_pending_subtask_fetches(self):
+        self.asana_client.tasks.find_by_project.return_value = [
+                fixtures.task(id=1), fixtures.task(id=2), fixtures.task(id=3)]
+        self.asana_client.tasks.subtasks.side_effect = lambda task_id, fields: (
+                [fixtures.task(id=10 + task_id)])
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        with mock.patch("asana2sql.Project.MAX_PENDING_SUBTASK_FETCHES", 1):
+            project.export()
+
+        self.assertEqual(self.db_client.write_many.call_args[0][1],
+                         [(1,), (2,), (11,), (3,), (12,), (13,)])
+
+    def test_export_skips_tasks_without_subtasks(self):
+        task1 = fixtures.task(id=1)
+        task1["num_subtasks"] = 0
+        task2 = fixtures.task(id=2)
+        task2["num_subtasks"] = 1
+        self.asana_client.tasks.find_by_project.return_value = [task1, task2]
+        self.asana_client.tasks.subtasks.return_value = [fixtures.task(id=3)]
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        project.export()
+
+        self.asana_client.tasks.subtasks.assert_called_once_with(2, fields="gid")
+        self.assertEqual(self.db_client.write_many.call_args[0][1],
+                         [(1,), (2,), (3,)])
+
+    def test_export_duplicate_tasks(self):
+        self.asana_client.tasks.find_by_project.return_value = [
+                fixtures.task(id=1), fixtures.task(id=2), fixtures.task(id=1)]
+        self.asana_client.tasks.subtasks.side_effect = lambda task_id, fields: (
+                [fixtures.task(id=2), fixtures.task(id=3)] if task_id == 1 else [])
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        project.export()
+
+        self.assertEqual(self.asana_client.tasks.subtasks.call_count, 2)
+        self.assertEqual(self.db_client.write_many.call_args[0][1],
+                         [(1,), (2,), (3,)])
+
+    def test_export_subtasks(self):
+        self.asana_client.tasks.find_by_project.return_value = [
+                fixtures.task(id=1), fixtures.task(id=2)]
+        self.asana_client.tasks.subtasks.side_effect = lambda task_id, fields: (
+                [fixtures.task(id=10 + task_id)] if task_id == 1 else [])
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config,
+                          [SimpleField("gid", SqlType.INTEGER)])
+        project.export()
+
+        self.asana_client.tasks.find_by_project.assert_called_once_with(
+                1234, fields="gid,num_subtasks")
+        self.asana_client.tasks.subtasks.assert_has_calls([
+                mock.call(1, fields="gid"), mock.call(2, fields="gid")],
+                any_order=True)
+        self.assertEqual(self.db_client.write_many.call_args[0][1],
+                         [(1,), (2,), (11,)])
+
+    def test_project_data_disk_cache(self):
+        proj = fixtures.project(id=1234, name="Test Table")
+        self.asana_client.projects.find_by_id.return_value = proj
+        self.config.table_name = None
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.config.metadata_cache = os.path.join(cache_dir, "cache")
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config, [])
+        self.assertEqual(project.table_name(), "Test_Table")
+
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config, [])
+        self.assertEqual(project.table_name(), "Test_Table")
+        self.asana_client.projects.find_by_id.assert_called_once_with(1234)
+
+        self.config.no_cache = True
+        project = Project(self.asana_client, self.db_client, self.workspace, self.config, [])
+        self.assertEqual(project.table_name(), "Test_Table")
+        self.assertEqual(self.asana_client.projects.find_by_id.call_count, 2)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,12 @@
+import itertools
 import re
 
 
 def sql_safe_name(name):
     return re.sub("\W", "", re.sub("\s", "_", name))
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size items."""
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])